@@ -1,19 +1,38 @@
 #!/usr/bin/env python3
 import os
+import re
 import json
+import hashlib
 import textwrap
 import uuid
 import time
+import random
+import wave
+import subprocess
+import threading
+import multiprocessing
+from collections import Counter
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from dotenv import load_dotenv
 from gtts import gTTS
-from moviepy.editor import (
-    ColorClip, ImageClip, AudioFileClip,
-    CompositeVideoClip, VideoFileClip
-)
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
 from PIL import Image, ImageDraw, ImageFont
 
+# optional local TTS engines; gTTS (network) is the last resort
+try:
+    from piper import PiperVoice
+except ImportError:
+    PiperVoice = None
+try:
+    import pyttsx3
+except ImportError:
+    pyttsx3 = None
+
 # --- NEW: modern OpenAI client ---
+import openai
 from openai import OpenAI
 
 load_dotenv()
@@ -23,19 +42,51 @@ if not OPENAI_API_KEY:
     raise SystemExit("Set OPENAI_API_KEY in env or GitHub Secrets")
 
 # instantiate the new client
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)  # retries handled by create_chat_completion
 
 OUT_DIR = Path("outputs")
 ASSETS_DIR = Path("assets")  # optional
+PIPER_MODEL = Path(os.getenv("PIPER_MODEL", "en_US-lessac-medium.onnx"))  # optional
+TIPS_CACHE = os.getenv("TIPS_CACHE") == "1"  # dev only: reuse the last tips instead of calling the API
+TIPS_CACHE_DIR = OUT_DIR / ".tips_cache"  # parsed tips keyed by model/count/prompt
+STOCK_CACHE_DIR = OUT_DIR / ".stock_cache"  # stock clips pre-scaled to the output frame
 OUT_DIR.mkdir(exist_ok=True)
 ASSETS_DIR.mkdir(exist_ok=True)
 
 # ---- 1) Generate tech tips (uses new client.chat.completions.create) ----
-def generate_tech_tips(num_tips=5):
+_NUM_RE = re.compile(r'^\s*\d+[.)]\s*(.+)$')
+
+MAX_RETRY_DELAY = 60  # seconds; never let a Retry-After header stall the daily job
+
+def create_chat_completion(max_attempts=5, **kwargs):
+    # exponential backoff with jitter on rate limits and transient failures;
+    # a 429's Retry-After header wins over our own schedule (up to MAX_RETRY_DELAY)
+    for attempt in range(max_attempts):
+        try:
+            return client.chat.completions.create(**kwargs)
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+            # an exhausted quota won't recover by waiting
+            if attempt == max_attempts - 1 or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            delay = 2 ** attempt
+            response = getattr(e, "response", None)
+            if response is not None:
+                try:
+                    delay = float(response.headers.get("Retry-After", delay))
+                except ValueError:
+                    pass
+            time.sleep(min(delay, MAX_RETRY_DELAY) + random.random())
+
+def generate_tech_tips(num_tips=5, model="gpt-4"):
     prompt = f"Generate {num_tips} short, punchy tech tips suitable for a 15-30 second Instagram Reel. Each tip should be 1-2 short sentences. Number them."
+    # reuse a previous answer for the same request instead of hitting the API again
+    key = hashlib.sha256(f"{model}|{num_tips}|{prompt}".encode()).hexdigest()
+    cache_path = TIPS_CACHE_DIR / f"{key}.json"
+    if TIPS_CACHE and cache_path.exists():
+        return json.loads(cache_path.read_text())
     # Use the new client API
-    resp = client.chat.completions.create(
-        model="gpt-4",
+    resp = create_chat_completion(
+        model=model,
         messages=[{"role": "user", "content": prompt}],
         temperature=0.7,
         max_tokens=400,
@@ -48,108 +99,308 @@ def generate_tech_tips(num_tips=5):
         # fallback: try dictionary-style access if packaging returns dicts
         text = resp["choices"][0]["message"]["content"]
 
-    lines = []
-    for line in text.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        # remove leading numbering like "1." or "1)"
-        if len(line) > 1 and line[0].isdigit() and (line[1] in ['.', ')']):
-            # strip the numbering (first occurrence of '.' or ')')
-            idx = 1
-            while idx < len(line) and line[idx] not in ['.', ')']:
-                idx += 1
-            line = line[idx+1:].strip() if idx < len(line) else line
-        lines.append(line)
+    # remove leading numbering like "1." or "12)"
+    lines = [(m.group(1) if (m := _NUM_RE.match(line)) else line).strip()
+             for line in text.splitlines() if line.strip()]
     # fallback: if response is a paragraph, split into sentences
     if len(lines) < num_tips:
-        import re
         sentences = re.split(r'(?<=[.!?]) +', text)
         lines = [s.strip() for s in sentences if len(s.strip()) > 10][:num_tips]
-    return lines[:num_tips]
+    lines = lines[:num_tips]
+
+    # only cache a complete answer, so one bad reply doesn't stick to later runs;
+    # write atomically so a crashed run never leaves a half-written cache entry
+    if TIPS_CACHE and len(lines) == num_tips:
+        TIPS_CACHE_DIR.mkdir(exist_ok=True)
+        tmp = cache_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps(lines))
+        tmp.rename(cache_path)
+    return lines
+
+# ---- 2) Create voice: Piper -> pyttsx3 -> gTTS ----
+# pyttsx3 drives a single shared engine, so only one thread may use it at a time
+_PYTTSX3_LOCK = threading.Lock()
+
+# the Piper voice is loaded once per process; the lock stops concurrent TTS
+# threads from each loading the ONNX model on first use
+_PIPER_LOCK = threading.Lock()
+_PIPER_VOICE = None
+
+def _piper_voice():
+    global _PIPER_VOICE
+    with _PIPER_LOCK:
+        if _PIPER_VOICE is None:
+            _PIPER_VOICE = PiperVoice.load(str(PIPER_MODEL))
+        return _PIPER_VOICE
 
-# ---- 2) Create voice with gTTS ----
 def create_voice(text, out_path):
+    # returns the audio file actually written: local engines write a .wav next
+    # to out_path, gTTS writes out_path itself
+    wav_path = Path(out_path).with_suffix(".wav")
+    if PiperVoice is not None and PIPER_MODEL.exists():
+        try:
+            voice = _piper_voice()
+            with wave.open(str(wav_path), "wb") as wav_file:
+                voice.synthesize_wav(text, wav_file)
+            return wav_path
+        except Exception as e:
+            print("Piper TTS failed, falling back:", repr(e))
+            wav_path.unlink(missing_ok=True)
+    if pyttsx3 is not None:
+        try:
+            with _PYTTSX3_LOCK:
+                engine = pyttsx3.init()
+                engine.save_to_file(text, str(wav_path))
+                engine.runAndWait()
+            if wav_path.exists() and wav_path.stat().st_size > 0:
+                return wav_path
+        except Exception as e:
+            print("pyttsx3 TTS failed, falling back:", repr(e))
+        wav_path.unlink(missing_ok=True)
     tts = gTTS(text=text, lang='en', slow=False)
     tts.save(str(out_path))
+    return Path(out_path)
 
-# ---- 3) Create text image with PIL and return ImageClip ----
-def create_text_image_clip(text, w=1080, h=1920, fontsize=72, duration=8):
+# ---- 3) Render tip text (and optional solid background) with PIL ----
+# fonts are opened once per (path, size) and reused for every tip
+_FONT_CACHE = {}
+
+def get_font(path, size):
+    key = (path, size)
+    if key not in _FONT_CACHE:
+        try:
+            _FONT_CACHE[key] = ImageFont.truetype(path, size)
+        except Exception:
+            _FONT_CACHE[key] = ImageFont.load_default()
+    return _FONT_CACHE[key]
+
+def render_text_image(text, w=1080, h=1920, fontsize=72, bg_color=None):
     wrapped = textwrap.fill(text, width=24)
-    img = Image.new("RGBA", (w, h), (0,0,0,0))
+    base = (*bg_color, 255) if bg_color else (0,0,0,0)
+    img = Image.new("RGBA", (w, h), base)
     draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("DejaVuSans-Bold.ttf", fontsize)
-    except Exception:
-        font = ImageFont.load_default()
-    lines = wrapped.split("\n")
-    # approximate line height
-    line_h = font.getsize("Ay")[1] + 10
-    y_text = int(h * 0.20)
-    for line in lines:
-        w_text, _ = draw.textsize(line, font=font)
-        x_text = (w - w_text) // 2
-        draw.text((x_text, y_text), line, font=font, fill=(255,255,255,255))
-        y_text += line_h
+    font = get_font("DejaVuSans-Bold.ttf", fontsize)
+    # lay out and draw the whole wrapped block in one pass, centered horizontally;
+    # Pillow steps lines by the height of "A" + spacing, so pick spacing to keep
+    # the original "Ay" height + 10px step
+    spacing = font.getbbox("Ay")[3] + 10 - font.getbbox("A")[3]
+    draw.multiline_text((w // 2, int(h * 0.20)), wrapped, font=font, anchor="ma", align="center", spacing=spacing, fill=(255,255,255,255))
     cta = "Follow for daily tech tips ➜ @yourhandle"
-    w_cta, _ = draw.textsize(cta, font=font)
-    draw.text(((w - w_cta)//2, int(h*0.88)), cta, font=font, fill=(230,230,230,255))
-    tmp = OUT_DIR / f"text_{uuid.uuid4().hex}.png"
-    img.save(tmp)
-    clip = ImageClip(str(tmp)).set_duration(duration)
-    return clip, tmp
-
-# ---- 4) Build vertical video (1080x1920) ----
-def build_video(tip_text, output_path, duration=None, bg_color=(18,18,18), use_stock_clip=None):
-    audio_file = output_path.with_suffix(".mp3")
-    create_voice(tip_text, audio_file)
-    audio = AudioFileClip(str(audio_file))
-    aud_duration = audio.duration
-    clip_duration = duration if duration else max(8, min(25, aud_duration + 0.5))
-    W, H = 1080, 1920
+    draw.text((w // 2, int(h*0.88)), cta, font=font, anchor="ma", fill=(230,230,230,255))
+    return img
+
+# ---- 4) Pick the fastest H.264 encoder this ffmpeg/machine supports ----
+# encoder -> extra ffmpeg params; first one that actually works wins
+HW_ENCODERS = {
+    "h264_nvenc": ["-preset", "p1", "-rc", "vbr", "-cq", "28", "-pix_fmt", "yuv420p"],
+    "h264_videotoolbox": ["-q:v", "60", "-pix_fmt", "yuv420p"],
+    "h264_qsv": ["-preset", "veryfast", "-global_quality", "28", "-pix_fmt", "nv12"],
+    "h264_vaapi": ["-vaapi_device", "/dev/dri/renderD128", "-qp", "28"],
+}
+# encoders that need frames uploaded to the GPU as the last filter step
+HW_UPLOAD = {
+    "h264_vaapi": "format=nv12,hwupload",
+}
 
-    # background: stock clip or solid color
-    if use_stock_clip and Path(use_stock_clip).exists():
+@lru_cache(maxsize=None)
+def detect_best_encoder():
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    try:
+        listed = subprocess.run([ffmpeg, "-hide_banner", "-encoders"], capture_output=True, text=True).stdout
+    except Exception:
+        return "libx264"
+    for codec, params in HW_ENCODERS.items():
+        if codec not in listed:
+            continue
+        # being compiled in doesn't mean the hardware is there: try a one-frame encode
+        probe = [ffmpeg, "-hide_banner", "-loglevel", "error",
+                 "-f", "lavfi", "-i", "color=size=256x256:rate=1",
+                 "-frames:v", "1", "-c:v", codec] + params
+        if codec in HW_UPLOAD:
+            probe += ["-vf", HW_UPLOAD[codec]]
+        probe += ["-f", "null", "-"]
         try:
-            bg = VideoFileClip(str(use_stock_clip)).resize(height=H)
-            if bg.w > W:
-                bg = bg.crop(width=W, height=H, x_center=bg.w/2, y_center=bg.h/2)
-            bg = bg.subclip(0, min(clip_duration, bg.duration)).set_duration(clip_duration)
+            if subprocess.run(probe, capture_output=True, timeout=20).returncode == 0:
+                return codec
         except Exception:
-            bg = ColorClip(size=(W, H), color=bg_color, duration=clip_duration)
+            pass
+    return "libx264"
+
+def available_cores():
+    # cores this process may actually run on (containers/CI often allow fewer than cpu_count)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def encoder_params(codec, still=False, threads=None):
+    if codec == "libx264":
+        # near-static content: motion search buys nothing, so use the fastest preset
+        params = ["-preset", "ultrafast", "-pix_fmt", "yuv420p"]
+        if still:
+            params = ["-tune", "stillimage"] + params
     else:
-        bg = ColorClip(size=(W, H), color=bg_color, duration=clip_duration)
+        # hardware encoders take their own rate-control/preset flags
+        params = list(HW_ENCODERS[codec])
+    if threads:
+        params += ["-threads", str(threads)]
+    return params + ["-movflags", "+faststart"]
 
-    txt_clip, tmp_img = create_text_image_clip(tip_text, w=W, h=H, fontsize=72, duration=clip_duration)
-    txt_clip = txt_clip.set_position(("center","center"))
+# ---- 5) Build vertical video (1080x1920) ----
+def raw_frame_input(img):
+    # feed a PIL image to ffmpeg as one raw frame on stdin: no PNG encode, file or unlink
+    pix_fmt = {"RGB": "rgb24", "RGBA": "rgba"}[img.mode]
+    return ["-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{img.width}x{img.height}",
+            "-framerate", "24", "-i", "pipe:0"]
 
-    final = CompositeVideoClip([bg, txt_clip], size=(W, H)).set_duration(clip_duration)
-    final = final.set_audio(audio)
+def encode_still(frame, audio_file, output_path, duration, codec, threads=None):
+    # one frame held for the whole clip: ffmpeg repeats it, no moviepy frames
+    vf = "loop=loop=-1:size=1:start=0"
+    if codec in HW_UPLOAD:
+        vf += "," + HW_UPLOAD[codec]
+    cmd = [get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error"] + raw_frame_input(frame) + [
+           "-i", str(audio_file),
+           "-map", "0:v", "-map", "1:a",
+           "-vf", vf,
+           "-c:v", codec] + encoder_params(codec, still=True, threads=threads) + [
+           "-c:a", "aac", "-t", f"{duration:.3f}", str(output_path)]
+    subprocess.run(cmd, input=frame.tobytes(), check=True)
 
-    final.write_videofile(str(output_path), fps=24, codec="libx264", audio_codec="aac", threads=2, preset="medium", verbose=False, logger=None)
+def encode_with_stock(stock_path, overlay, audio_file, output_path, duration, codec, W=1080, H=1920, threads=None):
+    # scale/crop the stock clip to fill the frame, loop it if it's too short,
+    # and overlay the transparent text layer (overlay holds its single frame), all inside one ffmpeg process
+    graph = (f"[0:v]scale={W}:{H}:force_original_aspect_ratio=increase,crop={W}:{H},setsar=1,fps=24[bg];"
+             f"[bg][1:v]overlay=0:0:eof_action=repeat")
+    if codec in HW_UPLOAD:
+        graph += "," + HW_UPLOAD[codec]
+    graph += "[v]"
+    cmd = [get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error",
+           "-stream_loop", "-1", "-i", str(stock_path)] + raw_frame_input(overlay) + [
+           "-i", str(audio_file),
+           "-filter_complex", graph,
+           "-map", "[v]", "-map", "2:a",
+           "-c:v", codec] + encoder_params(codec, threads=threads) + [
+           "-c:a", "aac", "-t", f"{duration:.3f}", str(output_path)]
+    subprocess.run(cmd, input=overlay.tobytes(), check=True)
 
+def stock_cache_path(stock_path, W=1080, H=1920, max_duration=25):
+    src = Path(stock_path)
+    st = src.stat()
+    key = hashlib.sha256(f"{src.resolve()}|{st.st_size}|{st.st_mtime_ns}|{W}x{H}|{max_duration}".encode()).hexdigest()
+    return STOCK_CACHE_DIR / f"{key}.mp4"
+
+def prune_stock_cache(stock_paths, W=1080, H=1920, max_duration=25):
+    # the key includes the source mtime, so an edited or removed asset leaves its old
+    # intermediate behind; keep only entries for the assets that exist now
+    if not STOCK_CACHE_DIR.exists():
+        return
+    keep = {stock_cache_path(p, W, H, max_duration) for p in stock_paths}
+    for f in STOCK_CACHE_DIR.iterdir():
+        if f not in keep and (f.suffix == ".mp4" or time.time() - f.stat().st_mtime > 3600):
+            f.unlink(missing_ok=True)
+
+def normalize_stock_clip(stock_path, W=1080, H=1920, max_duration=25):
+    # scale/crop/resample a stock clip to the output frame once, so every tip that
+    # shares it decodes a ready-made 1080x1920@24 stream instead of redoing that work
+    src = Path(stock_path)
+    out = stock_cache_path(src, W, H, max_duration)
+    if out.exists():
+        return out
+    STOCK_CACHE_DIR.mkdir(exist_ok=True)
+    tmp = out.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    cmd = [get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error",
+           "-i", str(src), "-t", str(max_duration), "-an",
+           "-vf", f"scale={W}:{H}:force_original_aspect_ratio=increase,crop={W}:{H},setsar=1,fps=24",
+           "-c:v", "libx264", "-preset", "ultrafast", "-crf", "14", "-pix_fmt", "yuv420p",
+           "-f", "mp4", str(tmp)]
     try:
-        audio.close()
-    except:
-        pass
-    try:
-        tmp_img.unlink()
-    except:
-        pass
+        subprocess.run(cmd, check=True)
+        tmp.rename(out)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return out
+
+def clip_length(audio_file, duration=None):
+    if duration:
+        return duration
+    aud_duration = ffmpeg_parse_infos(str(audio_file))["duration"]
+    return max(8, min(25, aud_duration + 0.5))
+
+def build_video_static(tip_text, output_path, audio_file, duration=None, bg_color=(18,18,18), codec=None, threads=None):
+    # solid background: the whole video is one frame, so it's PIL + one ffmpeg call, no frame pipeline
+    W, H = 1080, 1920
+    codec = codec or detect_best_encoder()
+    frame = render_text_image(tip_text, w=W, h=H, fontsize=72, bg_color=bg_color).convert("RGB")
+    encode_still(frame, audio_file, output_path, clip_length(audio_file, duration), codec, threads=threads)
+
+def build_video_with_stock(tip_text, output_path, stock_clip, audio_file, duration=None, bg_color=(18,18,18), codec=None, threads=None):
+    # moving background: overlay the text layer on the stock clip, falling back to
+    # the static render if the clip is missing or ffmpeg can't use it
+    W, H = 1080, 1920
+    codec = codec or detect_best_encoder()
+    if Path(stock_clip).exists():
+        overlay = render_text_image(tip_text, w=W, h=H, fontsize=72)
+        try:
+            encode_with_stock(stock_clip, overlay, audio_file, output_path, clip_length(audio_file, duration), codec, W=W, H=H, threads=threads)
+            return
+        except subprocess.CalledProcessError:
+            pass
+    build_video_static(tip_text, output_path, audio_file, duration=duration, bg_color=bg_color, codec=codec, threads=threads)
 
 # ---- main ----
 if __name__ == "__main__":
     tips = generate_tech_tips(num_tips=5)
     results = []
     stock_candidates = sorted(ASSETS_DIR.glob("*.mp4"))
+    stamp = int(time.time())
+    jobs = []
     for i, tip in enumerate(tips):
-        name = f"tech_tip_{int(time.time())}_{i+1}.mp4"
-        out_path = OUT_DIR / name
+        out_path = OUT_DIR / f"tech_tip_{stamp}_{i+1}.mp4"
         stock = str(stock_candidates[i % len(stock_candidates)]) if stock_candidates else None
-        print("Generating:", tip)
-        build_video(tip, out_path, use_stock_clip=stock)
-        results.append({"tip": tip, "file": str(out_path)})
-        time.sleep(1)
+        jobs.append((i, tip, out_path, stock))
+    prune_stock_cache(stock_candidates)
+    # stock clips shared by several tips get scaled/cropped once, alongside the TTS
+    uses = Counter(job[3] for job in jobs if job[3])
+    shared = [stock for stock, n in uses.items() if n > 1]
+    # probe encoders once here; spawned workers would otherwise each redo it
+    codec = detect_best_encoder()
+    print("Encoder:", codec)
+
+    # stage 1: synthesize every voice track concurrently (network or GIL-releasing TTS);
+    # stage 2: hand each track to the encode pool as soon as it is ready.
+    # spawn keeps the encode workers from forking while TTS threads are mid-request,
+    # and the cores are split so workers x encoder threads ~= cores
+    cores = available_cores()
+    pool_size = max(1, min(len(tips), cores))
+    threads_per_job = max(1, cores // pool_size)
+    encode_pool = ProcessPoolExecutor(max_workers=pool_size,
+                                      mp_context=multiprocessing.get_context("spawn"))
+    with ThreadPoolExecutor(max_workers=max(1, len(tips) + len(shared))) as tts_pool, encode_pool:
+        normalized = {stock: tts_pool.submit(normalize_stock_clip, stock) for stock in shared}
+        tts_futures = {}
+        for job in jobs:
+            i, tip, out_path, stock = job
+            print("Generating:", tip)
+            tts_futures[tts_pool.submit(create_voice, tip, out_path.with_suffix(".mp3"))] = job
+        encode_futures = {}
+        for fut in as_completed(tts_futures):
+            i, tip, out_path, stock = tts_futures[fut]
+            if stock in normalized:
+                try:
+                    stock = str(normalized[stock].result())
+                except subprocess.CalledProcessError:
+                    pass
+            if stock:
+                fut = encode_pool.submit(build_video_with_stock, tip, out_path, stock, fut.result(), codec=codec, threads=threads_per_job)
+            else:
+                fut = encode_pool.submit(build_video_static, tip, out_path, fut.result(), codec=codec, threads=threads_per_job)
+            encode_futures[fut] = (i, tip, out_path, stock)
+        for fut in as_completed(encode_futures):
+            i, tip, out_path, stock = encode_futures[fut]
+            fut.result()
+            print("Finished:", out_path.name)
+            results.append((i, {"tip": tip, "file": str(out_path)}))
+    results = [r for _, r in sorted(results, key=lambda x: x[0])]
 
     with open(OUT_DIR / "videos_log.json", "w") as f:
         json.dump(results, f, indent=2)